@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import argparse
+import functools
 import inspect
 import logging
 import multiprocessing
@@ -13,12 +14,15 @@ import time
 import math
 import json
 from collections import defaultdict, Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from packaging.version import Version
 
 t0 = time.time()
 script_filename = inspect.getframeinfo(inspect.currentframe()).filename
 script_path = os.path.dirname(os.path.abspath(script_filename))
 version = "1.22.0"
+cigar_pattern = re.compile(r'([0-9]+)([A-Z])')
+rev_comp_table = str.maketrans("ATCGatcg", "TAGCtagc")
 
 class Ref:
     file = "Ref_Paris_mompS_2.fasta"
@@ -89,16 +93,17 @@ class Ref:
 class SAM_data(object):
     """stores columns of SAM entry as attributes"""
     def __init__(self, object):
-        self.qname = object.split('\t')[0]
-        self.flag = int(object.split('\t')[1])
-        self.rname = object.split('\t')[2]
-        self.pos = int(object.split('\t')[3])
-        self.mapq = int(object.split('\t')[4])
-        self.cigar = object.split('\t')[5]
-        self.rnext = object.split('\t')[6]
-        self.pnext = object.split('\t')[7]
-        self.seq = object.split('\t')[9]
-        self.qual = object.split('\t')[10]
+        cols = object.split('\t')
+        self.qname = cols[0]
+        self.flag = int(cols[1])
+        self.rname = cols[2]
+        self.pos = int(cols[3])
+        self.mapq = int(cols[4])
+        self.cigar = cols[5]
+        self.rnext = cols[6]
+        self.pnext = cols[7]
+        self.seq = cols[9]
+        self.qual = cols[10]
         self.ln = len(self.seq)
         self.end = self.pos + self.ln
         self.mod_seq = ''
@@ -119,27 +124,33 @@ class SAM_data(object):
         According to the M, I, and D components of a cigar string, modifies a seq and quality score strings so that they are in register with refernce sequence 
         returns: modified sequence, modified quality score string
         """
-        cig_sects = re.findall('[0-9]+[A-Z]', self.cigar)
+        cig_sects = cigar_pattern.findall(self.cigar)
 
         count = 0
+        seq = self.seq
+        qual = self.qual
+        seq_parts = []
+        qual_parts = []
 
-        for sect in cig_sects:
-            letter = sect[-1]
-            sect_len = int(sect[:-1])
+        for sect_len, letter in cig_sects:
+            sect_len = int(sect_len)
             
             if letter == 'M':
-                self.mod_seq += self.seq[count:count+sect_len] # Add corresponding portion of original seq
-                self.mod_qual += self.qual[count:count+sect_len]
+                seq_parts.append(seq[count:count+sect_len]) # Add corresponding portion of original seq
+                qual_parts.append(qual[count:count+sect_len])
                 count += sect_len
 
             elif letter == 'D':
-                self.mod_seq += '*' * sect_len # Add asterisks for each deleted position relative to the reference sequence
-                self.mod_qual += ' ' * sect_len
+                seq_parts.append('*' * sect_len) # Add asterisks for each deleted position relative to the reference sequence
+                qual_parts.append(' ' * sect_len)
 
 
             elif letter == 'I' or letter == 'S':
                 count += sect_len
 
+        self.mod_seq = "".join(seq_parts)
+        self.mod_qual = "".join(qual_parts)
+
     def get_base_calls(self, positions):
         """
         Args:
@@ -151,7 +162,7 @@ class SAM_data(object):
                 base calls
         """
 
-        bases = {k:'' for k in range(len(positions))}
+        bases = [''] * len(positions)
  
         for n, p in enumerate(positions):
             p_mod = p+1 - self.pos
@@ -294,23 +305,7 @@ def rev_comp(string) -> str:
         raise TypeError(
             "string must be str, not {}.".format(type(string).__name__))
 
-    rev_str = ''
-    rev_comp_lookup = {
-    "A" : "T", 
-    "T" : "A", 
-    "C" : "G", 
-    "G" : "C", 
-    "a" : "t", 
-    "t" : "a", 
-    "c" : "g", 
-    "g" : "c",
-    }
-    for i in reversed(string):
-        if i in "ATCGatcg":
-            rev_str += rev_comp_lookup[i]
-        else:
-            rev_str += i
-    return rev_str
+    return string[::-1].translate(rev_comp_table)
 
 
 def check_input_supplied(
@@ -593,6 +588,26 @@ def check_files(inputs: dict) -> None:
         sys.exit(1)
 
 
+def check_blast_db(inputs: dict) -> None:
+    """Builds the BLAST index for the allele database only if it is missing
+
+    Parameters
+    ----------
+    inputs: dict
+        Run settings
+
+    Returns
+    -------
+    None
+        makeblastdb is run if any of the index files are absent
+    """
+    db = os.path.join(inputs["sbt"], "all_loci.fasta")
+    if all(os.path.isfile(db + ext) for ext in (".nhr", ".nin", ".nsq")):
+        logging.info("Found existing BLAST index for the allele database")
+        return
+    run_command(f"makeblastdb -in {db} -dbtype nucl", tool="makeblastdb")
+
+
 def ensure_safe_threads(inputs: dict, threads: int = 1) -> dict:
     """Ensures that the number of user supplied threads doesn't exceed system capacity
 
@@ -625,7 +640,8 @@ def run_command(command: str,
         desc_file: str = None,
         desc_header: str = None,
         column_headers: str = "",
-        log_output: bool = True
+        log_output: bool = True,
+        columns: tuple = None
         ) -> str:
     """Runs a command, and logs it nicely
 
@@ -657,6 +673,9 @@ def run_command(command: str,
     log_output: bool, optional
         Whether to log the output of the command
 
+    columns: tuple, optional
+        Indices of the tab-separated columns of the output to keep
+
     Returns
     -------
     str
@@ -687,19 +706,14 @@ def run_command(command: str,
 
 # Sort BLAST output in SBT order
     if tool == "blast":  
-        loci = ['flaA', 'pilE', 'asd', 'mip', 'mompS', 'proA', 'neuA_neuAH']
-        al = []
-        res_string = ''
+        result = sort_blast_by_locus(result, ['flaA', 'pilE', 'asd', 'mip', 'mompS', 'proA', 'neuA_neuAH'])
+
+    if columns is not None:
+        selected = []
         for line in result.splitlines():
-            line = line.split()
-            al.append(line)
-        res = [loc for x in loci for loc in al if x in loc[1]]
-        res = [" ".join(i) for i in res]
-        for i in res:
-            res_string += str(i)
-            res_string += '\n'
-        res_string = res_string.replace(" ", "\t")
-        result = res_string
+            cols = line.split("\t")
+            selected.append("\t".join([cols[i] for i in columns]) + "\n")
+        result = "".join(selected)
         
     if log_output:
         pretty_result = prettify("\n".join([column_headers, result]))
@@ -723,6 +737,65 @@ def run_command(command: str,
     return result
 
 
+def sort_blast_by_locus(result: str, loci: list) -> str:
+    """Orders tabular BLAST output by locus
+
+    Parameters
+    ----------
+    result: str
+        tabular BLAST output (sseqid in the second column)
+    loci: list
+        loci in the order in which hits should be returned
+
+    Returns
+    -------
+    str
+        tab-separated BLAST hits grouped by locus in the order of loci
+    """
+    hits = [line.split() for line in result.splitlines()]
+    return "".join(
+        ["\t".join(hit) + "\n" for locus in loci for hit in hits if locus in hit[1]]
+        )
+
+
+def run_command_stream(command: str, tool: str = None, shell: bool = False):
+    """Runs a command and yields its output line by line
+
+    Use instead of run_command when the output is large and only needs to
+    be consumed once, so it is never held in memory as a whole.
+
+    Parameters
+    ----------
+    command : str
+        The command to be executed. Converted to a list internally.
+
+    tool: str
+        The name of the tool for logging purposes
+
+    shell: bool, optional
+        shell option passed to Popen
+
+    Yields
+    ------
+    str
+        Lines of output generated by running the command
+    """
+    logging.debug(f"Running command: {command}")
+    full_command = command
+
+    if tool is not None:
+        logging.info(f"Running {tool}")
+    if not shell:
+        command = shlex.split(command, posix=False)
+    with subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8') as proc:
+        yield from proc.stdout
+    if proc.returncode != 0:
+        logging.critical(f"CRITICAL ERROR! The following command had an improper exit: \n{full_command}\n")
+        sys.exit(1)
+    if tool is not None:
+        logging.info(f"Finished running {tool}")
+
+
 def prettify(text, delim="\t"):
     lines = text.split("\n")
     # calculate padding for each column
@@ -761,7 +834,7 @@ def blast_momps_allele(inputs: dict, seq: str, db: str) -> list:
         mompS allele number
     """
     logging.debug(f"Looking for \n{seq}")
-    blastcmd = f"blastn -query - -db {db} -outfmt '6 std qlen slen sseqid' -max_target_seqs 50000 | awk -F'\\t' '{{OFS=FS}}{{gsub(/_.+/, \"\", $15)}}1' | sort -k15,15 -k12,12gr | sort -u  -k15,15"
+    blastcmd = f"blastn -query - -db {db} -outfmt '6 std qlen slen sseqid' -max_target_seqs 50000 -max_hsps 1 | awk -F'\\t' '{{OFS=FS}}{{gsub(/_.+/, \"\", $15)}}1' | sort -k15,15 -k12,12gr | sort -u  -k15,15"
     column_headers = "qseqid\tsseqid\tpident\tlength\tmismatch\tgapopen\tqstart\tqend\tsstart\tsend\tevalue\tbitscore\tqlen\tslen\tsseqid"
     res = run_command(blastcmd, "blastn/mompS", seq, shell=True, column_headers=column_headers).rstrip()
     if res == "":
@@ -770,9 +843,9 @@ def blast_momps_allele(inputs: dict, seq: str, db: str) -> list:
         bits = res.split()
         a = Allele()
         if float(bits[2]) == 100.00 and bits[3] == bits[13]:
-            a.allele_id = bits[1].split("_")[-1]
+            a.allele_id = bits[1].rpartition("_")[2]
         elif bits[3] == bits[13]:
-            a.allele_id = bits[1].split("_")[-1]+"*"
+            a.allele_id = bits[1].rpartition("_")[2]+"*"
         else:
             error_msg = f"The sequence of locus mompS did not return a full length match in the database\n"
             logging.info(error_msg)
@@ -840,8 +913,8 @@ def filter_blast_hits(blastresult: str, len_thresh: float = 0.3, pcnt_id_thresh:
     
     Parameters
     ----------
-    blastresult: str
-        raw blast output. Expects -outfmt '6 std qlen slen'
+    blastresult: str or iterable
+        raw blast output, or an iterable of its lines. Expects -outfmt '6 std qlen slen'
     len_thresh: float, optional
         the length of the blast hit needed to keep the hit
     pcnt_id_thresh: float, optional
@@ -856,11 +929,14 @@ def filter_blast_hits(blastresult: str, len_thresh: float = 0.3, pcnt_id_thresh:
     """
     good_hits = defaultdict(lambda: defaultdict(list))
 
-    for line in blastresult.split("\n"):
-        if len(line) == 0:
-            continue
+    if isinstance(blastresult, str):
+        blastresult = blastresult.split("\n")
+
+    for line in blastresult:
         bits = line.split()
-        locus = bits[1].split("_")[0]
+        if len(bits) == 0:
+            continue
+        locus = bits[1].partition("_")[0]
         if locus == "mompS" and not momps:
             continue
         contig = bits[0]
@@ -902,7 +978,25 @@ def filter_blast_hits(blastresult: str, len_thresh: float = 0.3, pcnt_id_thresh:
     return best_hits
 
 
-def blast_remaining_loci(inputs: dict, assembly_file: str, ref: Ref, momps: bool) -> dict:
+def assembly_blast_command(inputs: dict, assembly_file: str) -> str:
+    """Build the BLAST command searching the assembly against all loci
+
+    Parameters
+    ----------
+    inputs: dict
+        Run settings
+    assembly_file : str
+        Assembly file name
+
+    Returns
+    -------
+    str
+        blastn command
+    """
+    return f"blastn -query {assembly_file} -db {inputs['sbt']}/all_loci.fasta -outfmt '6 std qlen slen' -max_target_seqs 50000 -num_threads {inputs['threads']}"
+
+
+def blast_remaining_loci(inputs: dict, assembly_file: str, ref: Ref, momps: bool, blast_hits: str = None) -> dict:
     """Find the rest of alleles (not mompS if it was found using PCR) by BLAST search
 
     Parameters
@@ -915,6 +1009,9 @@ def blast_remaining_loci(inputs: dict, assembly_file: str, ref: Ref, momps: bool
         Information about reference sequence
     momps: bool
         Should the mompS allele be found by blast?
+    blast_hits: str, optional
+        Output of the command from assembly_blast_command, already passed
+        through filter_blast_hits with momps=True, if it was run beforehand
 
     Returns
     -------
@@ -925,36 +1022,28 @@ def blast_remaining_loci(inputs: dict, assembly_file: str, ref: Ref, momps: bool
     if momps:
         loci.insert(4, "mompS")
     calls = {k:[] for k in loci}
-    al = []
     j_list = []
     blast_list = []
     blast_dict = {}
     b_dict = {}
     loc_dict = {}
-    res_string = ''
 
     assembly_dict = fasta_to_dict(assembly_file)
 
-    blast_command = f"blastn -query {assembly_file} -db {inputs['sbt']}/all_loci.fasta -outfmt '6 std qlen slen' -max_target_seqs 50000"
+    blast_command = assembly_blast_command(inputs, assembly_file)
     desc_header = "Best match of each locus in provided assembly using BLASTN."
     column_headers = "qseqid\tsseqid\tpident\tlength\tmismatch\tgapopen\tqstart\tqend\tsstart\tsend\tevalue\tbitscore\tqlen\tslen"
-    result = run_command(blast_command, tool='blast', shell=True, log_output=False)
-        
-    result = filter_blast_hits(result, momps=momps, len_thresh=inputs['length'], pcnt_id_thresh=inputs['sequence'])
+    if blast_hits is None:
+        blast_hits = filter_blast_hits(
+            run_command_stream(blast_command, tool='blast', shell=True),
+            momps=True, len_thresh=inputs['length'], pcnt_id_thresh=inputs['sequence']
+            )
     
 
     # Now do the logging of the good blast hits
+    # (mompS hits are dropped here if mompS is not in loci)
     
-    for line in result.splitlines():
-        line = line.split()
-        al.append(line)
-    res = [loc for x in loci for loc in al if x in loc[1]]
-    res = [" ".join(i) for i in res]
-    for i in res:
-        res_string += str(i)
-        res_string += '\n'
-    res_string = res_string.replace(" ", "\t")
-    result = res_string
+    result = sort_blast_by_locus(blast_hits, loci)
 
     pretty_result = prettify("\n".join([column_headers, result]))
     logging.debug(f"Command log for blast:\n{pretty_result}")
@@ -997,10 +1086,10 @@ def blast_remaining_loci(inputs: dict, assembly_file: str, ref: Ref, momps: bool
         bits = line.split()
 
         # Find best match in db
-        locus = "_".join(bits[1].split("_")[:-1])
+        locus = bits[1].rpartition("_")[0]
         a = Allele()
         if float(bits[2]) == 100.00 and bits[3] == bits[13]:
-            a.allele_id = bits[1].split("_")[-1]
+            a.allele_id = bits[1].rpartition("_")[2]
         elif bits[3] == bits[13]:
             a.allele_id = "NAT"
         else:
@@ -1055,6 +1144,31 @@ def blast_remaining_loci(inputs: dict, assembly_file: str, ref: Ref, momps: bool
             
     return calls
 
+@functools.lru_cache(maxsize=None)
+def load_profile(profile_file: str) -> dict:
+    """Reads the allele profile table into a dict (read once per profile file)
+
+    Parameters
+    ----------
+    profile_file : str
+        profile file containing ST as the first column, and allele profiles in the next columns
+
+    Returns
+    -------
+    dict
+        dictionary of tab-separated allele profile (key) to ST (value)
+    """
+    profiles = {}
+    with open(profile_file, "r") as f:
+        f.readline()
+        for line in f:
+            cols = line.split()
+            if not cols:
+                continue
+            profiles.setdefault("\t".join(cols[1:]), cols[0])
+    return profiles
+
+
 def get_st(allele_profile: str, Ref: Ref, profile_file: str) -> str:
     """Looks for the ST in the allele profile table (simple look-up)
 
@@ -1084,14 +1198,7 @@ def get_st(allele_profile: str, Ref: Ref, profile_file: str) -> str:
     elif "NAT" in allele_profile:
          return novel_allele
       
-    with open(profile_file, "r") as f:
-        f.readline()
-        for line in f:
-            line = line.rstrip()
-            if "\t".join(line.split()[1:]) == allele_profile:
-                st = line.split("\t")[0]
-                return st
-    return novel_ST
+    return load_profile(profile_file).get(allele_profile, novel_ST)
 
 
 def read_sam_file(samfile: str):
@@ -1099,7 +1206,7 @@ def read_sam_file(samfile: str):
     read_info_dict = defaultdict(list) #{'readname': [SAM_data, SAM_data]}
 
     with open(samfile, 'r') as sam:
-        for line in sam.readlines():
+        for line in sam:
             if line[0] == "@":
                 continue
             
@@ -1197,15 +1304,19 @@ def process_reads(contig_dict: dict, read_info_dict: dict, ref: Ref, outdir: str
 
     # Check coverage of neuA/neuAh regions to infer which is present
 
-    logging.info("Processing sam file for downstream analysis.")
-    process_sam_command = f"samtools view -Sb {outdir}/reads_vs_all_ref_filt.sam | samtools sort - > {outdir}/reads_vs_all_ref_filt_sorted.bam; samtools index {outdir}/reads_vs_all_ref_filt_sorted.bam"
+    logging.info("Indexing sorted bam file for downstream analysis.")
+    process_sam_command = f"samtools index {outdir}/reads_vs_all_ref_filt_sorted.bam"
     run_command(process_sam_command, tool='samtools', shell=True)
 
     logging.info("Checking coverage of reference loci by mapped reads")
-    coverage_command = f"samtools coverage -r flaA:351-532 {outdir}/reads_vs_all_ref_filt_sorted.bam | cut -f 1,4,5,6,7,8,9; samtools coverage -r pilE:351-683 {outdir}/reads_vs_all_ref_filt_sorted.bam | tail -1 | cut -f 1,4,5,6,7,8,9; samtools coverage -r asd:351-823 {outdir}/reads_vs_all_ref_filt_sorted.bam | tail -1 | cut -f 1,4,5,6,7,8,9; samtools coverage -r mip:350-751 {outdir}/reads_vs_all_ref_filt_sorted.bam | tail -1 | cut -f 1,4,5,6,7,8,9; samtools coverage -r mompS:367-718 {outdir}/reads_vs_all_ref_filt_sorted.bam | tail -1 | cut -f 1,4,5,6,7,8,9; samtools coverage -r proA:350-754 {outdir}/reads_vs_all_ref_filt_sorted.bam | tail -1 | cut -f 1,4,5,6,7,8,9; samtools coverage -r neuA:350-703 {outdir}/reads_vs_all_ref_filt_sorted.bam | tail -1 | cut -f 1,4,5,6,7,8,9; samtools coverage -r neuAh:350-703 {outdir}/reads_vs_all_ref_filt_sorted.bam | tail -1 | cut -f 1,4,5,6,7,8,9; samtools coverage -r neuA_207:350-700 {outdir}/reads_vs_all_ref_filt_sorted.bam | tail -1 | cut -f 1,4,5,6,7,8,9; samtools coverage -r neuA_211:350-703 {outdir}/reads_vs_all_ref_filt_sorted.bam | tail -1 | cut -f 1,4,5,6,7,8,9; samtools coverage -r neuA_212:350-700 {outdir}/reads_vs_all_ref_filt_sorted.bam | tail -1 | cut -f 1,4,5,6,7,8,9; samtools coverage -r neuA_215:350-703 {outdir}/reads_vs_all_ref_filt_sorted.bam | tail -1 | cut -f 1,4,5,6,7,8,9"
+    coverage_command = "; ".join(
+        [f"samtools coverage {'-H ' if n else ''}-r {locus}:{pos['start_pos']}-{pos['end_pos']} {outdir}/reads_vs_all_ref_filt_sorted.bam"
+         for n, (locus, pos) in enumerate(ref.REF_POSITIONS.items())]
+        )
     desc_header = "Assessing coverage of MLST loci by provided sequencing reads."
 
-    result = run_command(coverage_command, tool='samtools coverage', shell=True, desc_file=f"{outdir}/intermediate_outputs.txt", desc_header=desc_header)
+    # Keep rname, numreads, covbases, coverage, meandepth, meanbaseq, meanmapq
+    result = run_command(coverage_command, tool='samtools coverage', shell=True, desc_file=f"{outdir}/intermediate_outputs.txt", desc_header=desc_header, columns=(0, 3, 4, 5, 6, 7, 8))
 
     alleles = {}
     cov_results = {}
@@ -1278,17 +1389,20 @@ def process_reads(contig_dict: dict, read_info_dict: dict, ref: Ref, outdir: str
     #ref.REF_POSITIONS = OrderedDict([(x, ref.REF_POSITIONS[x]) for loci in x])
     
 
+    min_qual = chr(20 + 33) # Base quality cutoff of 20, assuming Phred 33...
     for locus in ref.REF_POSITIONS:
         locus_reads = contig_dict[locus]
         allele_start = ref.REF_POSITIONS[locus]['start_pos']
         allele_stop = ref.REF_POSITIONS[locus]['end_pos']
 
-        # reads_dict {bases: {pos:base}, qualities: {pos:qual}, readnames: {pos:rname}}
+        # reads_dict {bases: {pos:base}, readnames: {pos:rname}}
+        # Only base calls passing the quality cutoff are kept in bases
         reads_dict ={
             'bases' : {k:[] for k in range(allele_start-1, allele_stop)},
-            'qualities' : {k:[] for k in range(allele_start-1, allele_stop)},
             'readnames' : {k:[] for k in range(allele_start-1, allele_stop)}
             }
+        bases = reads_dict['bases']
+        readnames = reads_dict['readnames']
 
         for read in locus_reads:
             if ( 
@@ -1303,24 +1417,21 @@ def process_reads(contig_dict: dict, read_info_dict: dict, ref: Ref, outdir: str
                     pad = 0
                 
 
-                for read_idx in range(pad, min([read.ln - 1, allele_stop+1-read.pos])):
-                    ref_seq_idx = read.pos + read_idx - 1
-                    reads_dict['bases'][ref_seq_idx].append(read.seq[read_idx])
-                    reads_dict['qualities'][ref_seq_idx].append(read.qual[read_idx])
-                    reads_dict['readnames'][ref_seq_idx].append(read.qname)
+                stop = min(read.ln - 1, allele_stop+1-read.pos)
+                ref_seq_idx = read.pos + pad - 1
+                qname = read.qname
+                for base, qual in zip(read.seq[pad:stop], read.qual[pad:stop]):
+                    if qual > min_qual:
+                        bases[ref_seq_idx].append(base)
+                    readnames[ref_seq_idx].append(qname)
+                    ref_seq_idx += 1
 
         seq = []
         cov = []
         for position in range(allele_start-1, allele_stop):
-            good_basecalls = [
-                base for base, qual in zip(
-                    reads_dict['bases'][position],
-                    reads_dict['qualities'][position]
-                    )
-                if ord(qual)-33 > 20 # Assuming Phred 33...
-                ]
+            good_basecalls = reads_dict['bases'][position]
             count = Counter(good_basecalls)
-            cov.append(sum([n for n in count.values()]))
+            cov.append(len(good_basecalls))
             if len(count) == 1:
                 seq.append([[b for b in count][0]])
             else:
@@ -1367,12 +1478,10 @@ def process_reads(contig_dict: dict, read_info_dict: dict, ref: Ref, outdir: str
             else:
                 alleles[locus] = [Allele(len(bialleles[0]), bialleles[i]) for i in range(len(bialleles))]
 
-            for base in seq:
-                for allele in alleles[locus]:
-                    if len(base) == 1:
-                        allele.seq += base[0]
-                    else:
-                        allele.seq += allele.basecalls[0]
+            for allele in alleles[locus]:
+                allele.seq = "".join(
+                    [base[0] if len(base) == 1 else allele.basecalls[0] for base in seq]
+                    )
 
         else:
             multi_allelic_idx = [n for n,i in enumerate(num_alleles_per_site) if i == 2]
@@ -1475,15 +1584,17 @@ def process_reads(contig_dict: dict, read_info_dict: dict, ref: Ref, outdir: str
             else:
                 alleles[locus] = [Allele(len(bialleles[0]), bialleles[i]) for i in range(len(bialleles))]
 
-            biallic_count = 0
-            for base in seq:
-                for allele in alleles[locus]:
+            for allele in alleles[locus]:
+                seq_parts = []
+                biallic_count = 0
+                for base in seq:
                     if len(base) == 1:
-                        allele.seq += base[0]
+                        seq_parts.append(base[0])
                     else:
-                        allele.seq += allele.basecalls[biallic_count]
-                if len(base) > 1:
-                    biallic_count+=1       
+                        seq_parts.append(allele.basecalls[biallic_count])
+                        if len(base) > 1:
+                            biallic_count+=1
+                allele.seq = "".join(seq_parts)
 
     with open(f"{outdir}/intermediate_outputs.txt", 'a') as f:
         f.write(cov_msg + "\n\n")
@@ -1540,10 +1651,15 @@ def write_alleles_to_file(alleles: list, outdir: str):
 
 
 def check_reads_are_mapped(inputs: dict, ref: Ref, samfile: str):
+    line_count = 0
     with open(samfile) as f:
-        line_count = sum([1 for line in f if line[0] != "@"])
-    if line_count > 10:
-        return
+        for line in f:
+            if line[0] == "@":
+                continue
+            line_count += 1
+            if line_count > 10:
+                # Enough reads mapped, no need to count the rest
+                return
     # < 10 reads mapped. Abort.
     logging.error("Critical error. The analysis could not be completed since the sample contains fewer than 10 reads that could align to the 7 SBT loci and thus likely indicates this sample is not L. pneumophila.")
     logging.error("Analysis Aborted")
@@ -1613,8 +1729,8 @@ def map_alleles(inputs: dict, ref: Ref):
     kmer_size = inputs["kmer_size"]
 
     # Run BWA mem
-    logging.info("Mapping reads to reference sequence, then filtering unmapped reads from sam file")
-    mapping_command = f"minimap2 -ax sr -k {kmer_size} -t {threads} {db}/ref_gene_regions.fna {r1} {r2} | samtools view -h -F 0x4 -@ {threads} -o {outdir}/reads_vs_all_ref_filt.sam"
+    logging.info("Mapping reads to reference sequence, then filtering unmapped reads from sam file and sorting to bam")
+    mapping_command = f"minimap2 -ax sr -k {kmer_size} -t {threads} {db}/ref_gene_regions.fna {r1} {r2} | samtools view -h -F 0x4 | tee {outdir}/reads_vs_all_ref_filt.sam | samtools sort -@ {threads} -o {outdir}/reads_vs_all_ref_filt_sorted.bam -"
     run_command(mapping_command, tool='minimap2 -ax sr', shell=True)
 
     # Check for issues with read mapping
@@ -1627,7 +1743,7 @@ def map_alleles(inputs: dict, ref: Ref):
     write_alleles_to_file(alleles, outdir)
     # BLAST alleles
     logging.info("BLASTing identified alleles against database")
-    blast_command = f"blastn -query {outdir}/identified_alleles.fna -db {db}/all_loci.fasta -outfmt '6 std qlen slen' -max_target_seqs 50000 | sort -k1,1 -k12,12gr | sort --merge -u  -k1,1"
+    blast_command = f"blastn -query {outdir}/identified_alleles.fna -db {db}/all_loci.fasta -outfmt '6 std qlen slen' -max_target_seqs 50000 -max_hsps 1 -num_threads {threads} | sort -k1,1 -k12,12gr | sort --merge -u  -k1,1"
     desc_header = "Best match of each identified sequence determined using BLASTN"
     column_headers = "qseqid\tsseqid\tpident\tlength\tmismatch\tgapopen\tqstart\tqend\tsstart\tsend\tevalue\tbitscore\tqlen\tslen"
 
@@ -1645,7 +1761,7 @@ def map_alleles(inputs: dict, ref: Ref):
             for allele_list in alleles.values():
                 for allele in allele_list:
                     if bits[0] == allele.fasta_header:
-                        allele.allele_id = bits[1].split("_")[-1]
+                        allele.allele_id = bits[1].rpartition("_")[2]
         else:
             for allele_list in alleles.values():
                 for allele in allele_list:
@@ -1819,12 +1935,20 @@ def choose_analysis_path(inputs: dict, ref: Ref) -> str:
     """
     alleles = {}
     if inputs["analysis_path"] == "a":
-        alleles["mompS"] = call_momps_pcr(inputs, assembly_file=inputs["assembly"])
+        # The assembly BLAST search doesn't depend on the PCR result, so run them together
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            blast_job = executor.submit(
+                filter_blast_hits,
+                run_command_stream(assembly_blast_command(inputs, inputs["assembly"]), tool='blast', shell=True),
+                momps=True, len_thresh=inputs['length'], pcnt_id_thresh=inputs['sequence']
+                )
+            alleles["mompS"] = call_momps_pcr(inputs, assembly_file=inputs["assembly"])
+            blast_hits = blast_job.result()
         if alleles["mompS"] == []:
-            alleles = blast_remaining_loci(inputs, assembly_file=inputs["assembly"], ref=ref, momps=True)
+            alleles = blast_remaining_loci(inputs, assembly_file=inputs["assembly"], ref=ref, momps=True, blast_hits=blast_hits)
         else:
             alleles_copy = alleles.copy()
-            alleles = {**blast_remaining_loci(inputs, assembly_file=inputs["assembly"], ref=ref, momps=False), **alleles_copy}
+            alleles = {**blast_remaining_loci(inputs, assembly_file=inputs["assembly"], ref=ref, momps=False, blast_hits=blast_hits), **alleles_copy}
         write_possible_mlsts(inputs=inputs, alleles=alleles, header=True, confidence=False)
         write_alleles_to_file(alleles, inputs['out_prefix'])
         for locus, a in alleles.items():
@@ -2001,6 +2125,7 @@ def main():
     logging.info("Checking if all the required input files exist")
     check_files(inputs)
     logging.info("Input files are present")
+    check_blast_db(inputs)
 
     logging.info("Ensuring thread counts are correct")
     inputs = ensure_safe_threads(inputs)
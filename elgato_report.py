@@ -2,12 +2,17 @@
 
 import sys
 import json
-import math
 import argparse
+import functools
+import itertools
 from dataclasses import dataclass
 from datetime import date
 from fpdf import FPDF
-from ctypes import alignment
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
 
 LOGO="""\
  /\\_/\\  
@@ -79,8 +84,13 @@ github_url = """ \
 https://github.com/CDCgov/el_gato \
 """
 
+@functools.lru_cache(maxsize=None)
+def format_header(template, version):
+	"""Fill in the el_gato version once per version, not once per sample"""
+	return template.format(version)
+
 @dataclass
-class Report(FPDF):
+class Report:
 	sample_id: str
 	st: str
 	flaA: str
@@ -127,13 +137,20 @@ class Report(FPDF):
 		)
 		return x
 
-	def list_mlst(self):
-		sample_id = self.sample_id
-		if self.shorten_names:
-			if len(self.sample_id) > 23:
-				sample_id = self.sample_id[:20] + "..."
+	def __post_init__(self):
+		# Sample ID as shown in tables, shortened once if requested
+		if self.shorten_names and len(self.sample_id) > 23:
+			self.sample_id_display = self.sample_id[:20] + "..."
+		else:
+			self.sample_id_display = self.sample_id
+		# Rows used in the PDF are built once here instead of on every table
+		self._mlst_row = self.make_mlst_row()
+		if self.mode == "Assembly":
+			self._locus_rows = self.make_locus_rows()
+
+	def make_mlst_row(self):
 		return [
-			sample_id,
+			self.sample_id_display,
 			self.st,
 			self.flaA,
 			self.pilE,
@@ -144,6 +161,28 @@ class Report(FPDF):
 			self.neuA_neuAH
 			]
 
+	def list_mlst(self):
+		return self._mlst_row
+
+	def make_locus_rows(self):
+		contents = []
+		for k, v in self.mode_specific["BLAST_hit_locations"].items():
+			rows = []
+			for row in v:
+				# set % length, leaving the loaded JSON rows untouched
+				p_length = 100*(int(row[-2])-int(row[-3])+1)/int(row[-1])
+				row = row[:-1] + [f"{p_length:.1f}"]
+				# shorten contig names if needed
+				if self.shorten_names:
+					if len(row[1]) > 28:
+						row[1] = row[1][:25] + "..."
+				rows.append(row)
+
+			contents.append([k] + rows[0])
+			for row in rows[1:]:
+				contents.append([""] + row)
+		return contents
+
 	def sample_report(
 		self,
 		pdf,
@@ -168,7 +207,6 @@ class Report(FPDF):
 		return pdf
 
 	def reads_report(self, pdf, typeface, style, size):
-		pdf.set_font(typeface, style, size)
 		pdf.set_font('Courier', 'B', 10)
 		pdf.multi_cell(
 			h=4,w=0,
@@ -177,7 +215,7 @@ class Report(FPDF):
 			markdown=True
 		)
 		pdf.ln(10)
-		pdf.set_font('Courier', '', 11)
+		pdf.set_font(typeface, style, size)
 		pdf.multi_cell(
 			h=4, w=0,
 			text=f"**{self.sample_id} reads report**",
@@ -187,12 +225,12 @@ class Report(FPDF):
 		pdf.ln(2)
 		pdf.multi_cell(
 			w=0,h=5,
-			text=reads_header.format(self.version),
+			text=format_header(reads_header, self.version),
 			new_x="LMARGIN", new_y="NEXT"
 			)
 		pdf.ln(8)
 
-		pdf = self.make_mlst_table(pdf, [self.list_mlst()], self.shorten_names)
+		pdf = self.make_mlst_table(pdf, [self.list_mlst()])
 		pdf.ln(6)
 
 		pdf.set_font(style="BU")
@@ -223,13 +261,17 @@ class Report(FPDF):
 
 	def read_coverage_table(self, pdf):
 		contents = [["Locus", "Percent Covered", "Mean Depth", "Minimum Depth", "Low depth bases"]]
+		def fmt(v, key):
+			x = v.get(key)
+			return "-" if x is None else f"{float(x):.1f}"
+
 		contents += [
 			[
 				k,
-				f'{float(v["Percent_covered"]):.1f}' if "Percent_covered" in v else "-",
-				f'{float(v["Mean_depth"]):.1f}' if "Mean_depth" in v else "-",
-				f'{float(v["Min_depth"]):.1f}' if "Min_depth" in v else "-",
-				f'{float(v["Num_below_min_depth"]):.1f}' if "Num_below_min_depth" in v else "-"
+				fmt(v, "Percent_covered"),
+				fmt(v, "Mean_depth"),
+				fmt(v, "Min_depth"),
+				fmt(v, "Num_below_min_depth")
 			] for k, v in self.mode_specific["locus_coverage"].items()]
 		col_widths = (37.5, 37.5, 37.5, 37.5, 37.5)
 		alignment = ("CENTER", "CENTER", "CENTER", "CENTER", "CENTER")
@@ -262,7 +304,6 @@ class Report(FPDF):
 		return pdf
 
 	def assembly_report(self, pdf, typeface, style, size):
-		pdf.set_font(typeface, style, size)
 		pdf.set_font('Courier', 'B', 10)
 		pdf.multi_cell(
 			h=4,w=0,
@@ -271,8 +312,7 @@ class Report(FPDF):
 			markdown=True
 		)
 		pdf.ln(10)
-		pdf.set_font('Courier', '', 11)
-		pdf.set_font(style="U")
+		pdf.set_font(typeface, style + "U", size)
 		pdf.multi_cell(
 			h=4, w=0,
 			text=f"**{self.sample_id.replace('_',' ')} genomic report**",
@@ -283,11 +323,11 @@ class Report(FPDF):
 		pdf.ln(2)
 		pdf.multi_cell(
 			w=0,h=5,
-			text=assembly_header.format(self.version),
+			text=format_header(assembly_header, self.version),
 			new_x="LMARGIN", new_y="NEXT"
 			)
 		pdf.ln(10)
-		pdf = self.make_mlst_table(pdf, [self.list_mlst()], self.shorten_names)
+		pdf = self.make_mlst_table(pdf, [self.list_mlst()])
 		pdf.ln(8)
 
 		pdf.set_font(style="BU")
@@ -303,34 +343,17 @@ class Report(FPDF):
 
 	def locus_location_table(self, pdf):
 		header = [["locus", "allele", "contig", "start", "stop", "%length"]]
-		contents = []
-		x = 1
-		for k, v in self.mode_specific["BLAST_hit_locations"].items():
-			for row in v:
-				# set % length
-				p_length = 100*(int(row[-2])-int(row[-3])+1)/int(row[-1])
-				row[-1] = (f"{p_length:.1f}")
-				# shorten contig names if needed
-				if self.shorten_names:
-					if len(row[1]) > 28:
-						row[1] = row[1][:25] + "..."
-
-			contents.append([k] + v[0])
-			if len(v) > 1:
-				for row in v[1:]:
-					contents.append([""] + row)
+		contents = self._locus_rows
 
 		col_widths = (20, 30, 50, 15, 15, 15)
 		alignment = ("CENTER", "CENTER", "CENTER", "CENTER", "CENTER", "CENTER")
 
-		content = [i for i in contents]
-
 		# if shortening names, don't adjust table for long lines
 		if self.shorten_names:
 			chars = 1000
 		else:
 			chars = 25
-		batches = self.fit_table(pdf, content, pdf.get_y(), chars)
+		batches = self.fit_table(pdf, contents, pdf.get_y(), chars)
 		# Add a header to each table
 		for i in range(len(batches)):
 			batches[i] = header + batches[i]
@@ -361,51 +384,72 @@ class Report(FPDF):
 		return pdf
 
 	def split_highlight_batches(self, batches, highlight_rows):
+		# Walk the sorted rows once, moving to the next batch as rows run past it
+		highlight_rows = sorted(highlight_rows)
 		highlight_list = []
+		i = 0
+		offset = 0
 		for batch in batches:
 			size = len(batch)
-			highlight_list.append(set([i for i in highlight_rows if i <= size]))
-			highlight_rows = [i-size for i in highlight_rows if i-size > 0]
+			batch_rows = set()
+			while i < len(highlight_rows) and highlight_rows[i] - offset <= size:
+				batch_rows.add(highlight_rows[i] - offset)
+				i += 1
+			highlight_list.append(batch_rows)
+			offset += size
 		return highlight_list
 
 	@staticmethod
-	def make_table(pdf, data, col_widths=None, text_align=None, highlight_rows=set()):
+	def make_table(pdf, data, col_widths=None, text_align=None, highlight_rows=None):
+		highlight_rows = set(highlight_rows or ())
 		with pdf.table(
 			col_widths=col_widths,
 			text_align=text_align,
 		) as table:
+			pdf.set_fill_color(0, 0, 0)
+			highlighted = False
 			for n, data_row in enumerate(data):
-				row = table.row()
-				if n in highlight_rows:
-					pdf.set_fill_color(243, 177, 170)
-				else:
-					pdf.set_fill_color(0, 0, 0)
-				for item in data_row:
-					row.cell(item)
+				# Only change the fill color at the edges of highlighted runs
+				if (n in highlight_rows) != highlighted:
+					highlighted = not highlighted
+					if highlighted:
+						pdf.set_fill_color(243, 177, 170)
+					else:
+						pdf.set_fill_color(0, 0, 0)
+				table.row(data_row)
 			pdf.set_fill_color(0, 0, 0)
 			return pdf
 	
 	@staticmethod
-	def fit_table(pdf, data, initial_y, characters:int):
+	def fit_table(pdf, data, initial_y, characters):
+		# characters: how many characters fit on one line of a cell, either
+		# one number for all columns or a tuple with one number per column
 		font_size = pdf.font_size
-		pdf_y = initial_y
+		# Each table starts with a heading row, and every batch after the first
+		# starts below the top margin, header and the 10 mm gap left by callers
+		heading_height = 2 * font_size
+		new_page_y = pdf.t_margin + getattr(pdf, "head_spacing", 0) + 10 + heading_height
+		pdf_y = initial_y + heading_height
+		# Rows must end 10 mm above the page break trigger
+		max_y = pdf.page_break_trigger - 10
+		# One character count per column, worked out once for every row
+		if isinstance(characters, int):
+			characters = itertools.repeat(characters)
+		else:
+			characters = tuple(characters)
 		n = 0
-		max_length = 0
 		batches = []
 		this_batch = []
 		while n < len(data):
 			row = data[n]
-			for i in row:
-				column_length = len(i)
-				if column_length > max_length:
-					max_length = column_length
-			num_lines = math.ceil(max_length / characters)
+			# Height of this row is set by its own tallest cell
+			num_lines = max((len(i) + c - 1) // c for i, c in zip(row, characters))
 			cell_height = 2* num_lines * font_size
-			if pdf_y + cell_height + 10 > pdf.page_break_trigger:
+			if pdf_y + cell_height > max_y:
 				batches.append(this_batch)
 				this_batch = [row]
 				n+=1
-				pdf_y = pdf.head_spacing # Whatever we want the starting y position to be on a new page
+				pdf_y = new_page_y + cell_height
 				continue
 
 			n+=1
@@ -415,36 +459,36 @@ class Report(FPDF):
 		return batches		
 
 	@staticmethod
-	def make_mlst_table(pdf, data, shorten_names=False):
+	def make_mlst_table(pdf, data):
 		contents = [["Sample ID","ST","flaA","pilE","asd","mip","mompS","proA","neuA"]]
-		for sample in data:
-			if shorten_names:
-				# Make sure sample id is fewer than XXX characters
-				s_name = sample[0]
-				if len(s_name) > 23:
-					sample[0] = s_name[0:20] + "..."
-			contents.append(sample)
+		contents += data
 		col_widths = (60, 18, 18, 18, 18, 18, 18, 18, 18)
 		alignment = ("CENTER", "CENTER", "CENTER", "CENTER", "CENTER", "CENTER", "CENTER", "CENTER", "CENTER")
 		pdf = Report.make_table(pdf, contents, col_widths=col_widths, text_align=alignment)
 		return pdf
 
+	@staticmethod
+	def load_json(file):
+		"""Parse a JSON file, using orjson if it is installed"""
+		with open(file, "rb") as fin:
+			if orjson is not None:
+				return orjson.loads(fin.read())
+			return json.load(fin)
+
 	@staticmethod
 	def read_jsons(files, shorten_names=False):
 		data = []
 		for file in files:
-			with open(file) as fin:
-				json_data = json.load(fin)
-				data.append(Report.from_json(json_data, shorten_names))
+			json_data = Report.load_json(file)
+			data.append(Report.from_json(json_data, shorten_names))
 		return data
 	
 	@staticmethod
 	def read_multi_json(files, shorten_names=False):
 		data = []
-		with open(files) as fin:
-			json_data = json.load(fin)
-			for i in json_data:
-				data.append(Report.from_json(i, shorten_names))
+		json_data = Report.load_json(files)
+		for i in json_data:
+			data.append(Report.from_json(i, shorten_names))
 				
 		return data	
 
@@ -498,14 +542,9 @@ class PDF_with_header(PDF_no_header):
 		self.ln(2)
 
 	def calc_head_size(self):
-		header_lines = self.header_text.split("\n")
-		newlines = len(header_lines) - 1
-
-		for line in header_lines:
-			if len(line) < 91:
-				continue
-			newlines += len(line) // 91\
-			
+		# One line per newline, plus one per 91 characters of a wrapped line
+		newlines = self.header_text.count("\n")
+		newlines += sum(len(line) // 91 for line in self.header_text.split("\n"))
 		return newlines * 5
 
 help_message= """
@@ -514,7 +553,7 @@ usage: elgato_report.py [-h] -i INPUT_JSONS [INPUT_JSONS ...] -o OUT_REPORT [-s]
 options:
   -h, --help            show this help message and exit
   -i, --input_jsons     path to one or more report.json files
-  -o, --out_report      desired output pdf file path
+  -o, --out_report      desired output pdf file path (use - for stdout)
   -s, --shorten_names   shorten long sample and contig names to prevent line wrapping
   -n, --no_header       Do not include the header in the report
   -d,  --disclaimer_file     Include disclaimer in footer
@@ -541,7 +580,7 @@ def parse_args():
 	p.add_argument(
 		"-o", "--out_report",
 		required=True,
-		help="desired output pdf file path"
+		help="desired output pdf file path (use - for stdout)"
 	)
 	p.add_argument(
 		"-s", "--shorten_names",
@@ -584,11 +623,13 @@ def main():
 		sys.exit("ERROR: You provided both a header file and a header string.\nPlease only provide one of a header file or a header string.")
 
 	# Load input JSONs
-	with open(args.input_jsons[0]) as fin:
-		if fin.read().startswith("["):
-			data = Report.read_multi_json(args.input_jsons[0], args.shorten_names)
-		else:
-			data = Report.read_jsons(args.input_jsons, args.shorten_names)
+	# Only the start of the first file is needed to tell a combined JSON list apart
+	with open(args.input_jsons[0], "rb") as fin:
+		head = fin.read(64).lstrip()
+	if head[:1] == b"[":
+		data = Report.read_multi_json(args.input_jsons[0], args.shorten_names)
+	else:
+		data = Report.read_jsons(args.input_jsons, args.shorten_names)
 
 	report_header = default_report_header
 	if args.custom_header:
@@ -626,8 +667,7 @@ def main():
 	pdf.set_font('Courier', '', 16)
 	pdf.multi_cell(w=0,h=6, text=LOGO, new_x="LMARGIN", new_y="NEXT")
 	pdf.ln(5)
-	pdf.set_font('Courier', '', 11)
-	pdf.set_font(style="U")
+	pdf.set_font('Courier', 'U', 11)
 	pdf.multi_cell(
 		h=4, w=0,
 		text="**Report Summary**",
@@ -642,20 +682,21 @@ def main():
 	
 	content = [i.list_mlst() for i in data]
 	# if shortening names, don't adjust table for long lines
+	# the narrow ST and allele columns can still wrap (e.g., Novel ST*)
 	if args.shorten_names:
-		chars = 1000
+		chars = (1000, 6, 6, 6, 6, 6, 6, 6, 6)
 	else:
-		chars = 19
+		chars = (19, 6, 6, 6, 6, 6, 6, 6, 6)
 	batches = Report.fit_table(pdf, content, pdf.get_y(), chars)
 	for batch in batches:
 		if batch != batches[-1]:
 			pdf.set_font('Courier', '', 11)
-			pdf = Report.make_mlst_table(pdf, batch, args.shorten_names)
+			pdf = Report.make_mlst_table(pdf, batch)
 			pdf.add_page()
 			pdf.ln(10)
 		else:
 			pdf.set_font('Courier', '', 11)
-			pdf = Report.make_mlst_table(pdf, batch, args.shorten_names)
+			pdf = Report.make_mlst_table(pdf, batch)
 			pdf.ln(5)
 	if pdf.get_y() + 50 > pdf.page_break_trigger:
 		pdf.add_page()
@@ -682,7 +723,12 @@ def main():
 	for datum in data:
 		pdf = datum.sample_report(pdf)
 
-	pdf.output(args.out_report)
+	# Write straight to stdout when piping, rather than through a file path
+	if args.out_report in ("-", "/dev/stdout"):
+		sys.stdout.buffer.write(pdf.output())
+		sys.stdout.buffer.flush()
+	else:
+		pdf.output(args.out_report)
 
 if __name__ == '__main__':
 	main()